@@ -0,0 +1,246 @@
+import pytest, threading, time, types
+import numpy as np
+import scipy.signal as signal
+import tone_compare as tc
+
+C_SAMPLE_RATE_Hz = 44100
+C_FREQS_Hz = [440, 880]
+
+def two_tone(duration_s:float, amplitudes=(1.0, 0.5), freqs=C_FREQS_Hz, sample_rate_Hz=C_SAMPLE_RATE_Hz) -> np.ndarray:
+
+    t = np.arange(int(duration_s * sample_rate_Hz)) / sample_rate_Hz
+    return sum(a * np.sin(2 * np.pi * f * t) for a, f in zip(amplitudes, freqs))
+
+@pytest.mark.parametrize("n_buffers", [1, 3, 7])
+def test_tone_monitor_matches_continuous_filter(n_buffers:int):
+
+    # Filtering consecutive buffers with carried state must equal one pass over the whole stream
+    audio = two_tone(1.0)
+    buffers = np.array_split(audio, n_buffers)
+    monitor = tc.ToneMonitor(C_SAMPLE_RATE_Hz, C_FREQS_Hz)
+    measured = [monitor.get_time_domain_ratio(buffer)[0] for buffer in buffers]
+
+    for i, sos in enumerate(monitor.sos_per_freq):
+        filtered, _ = signal.sosfilt(sos, audio, zi=signal.sosfilt_zi(sos) * audio[0])
+        expected = [np.sqrt(np.mean(chunk**2)) for chunk in np.array_split(filtered, n_buffers)]
+        print(f"\n  {C_FREQS_Hz[i]}Hz expected RMS={expected}; measured={[values[i] for values in measured]}")
+        assert [values[i] for values in measured] == pytest.approx(expected, rel=1e-9)
+
+def test_tone_monitor_reset():
+
+    # After reset() the next buffer is seeded afresh, exactly like a new monitor
+    audio = two_tone(0.25)
+    other = two_tone(0.25, amplitudes=(0.3, 0.9))
+    monitor = tc.ToneMonitor(C_SAMPLE_RATE_Hz, C_FREQS_Hz)
+    monitor.get_time_domain_ratio(other)
+    carried, _ = monitor.get_time_domain_ratio(audio)
+
+    monitor.reset()
+    assert monitor.zi_per_freq == [None] * len(C_FREQS_Hz)
+    after_reset, _ = monitor.get_time_domain_ratio(audio)
+    fresh, _ = tc.ToneMonitor(C_SAMPLE_RATE_Hz, C_FREQS_Hz).get_time_domain_ratio(audio)
+    print(f"\n  fresh={fresh}; after reset={after_reset}; carried={carried}")
+    assert after_reset == pytest.approx(fresh, rel=1e-12)
+    assert carried != pytest.approx(fresh, rel=1e-6)
+
+@pytest.mark.parametrize("freq_a_Hz, freq_b_Hz, n_samples", [
+    (440, 880, 20011),
+    (440, 660, 22051),
+    (1000, 1500, 44101),
+])
+def test_fft_peak_ratio(freq_a_Hz:float, freq_b_Hz:float, n_samples:int):
+
+    # Tones on exact bins of the transform, at lengths that are not fast FFT sizes
+    freqs = [round(f * n_samples / C_SAMPLE_RATE_Hz) * C_SAMPLE_RATE_Hz / n_samples for f in (freq_a_Hz, freq_b_Hz)]
+    audio = two_tone(n_samples / C_SAMPLE_RATE_Hz, freqs=freqs)
+    _, ratio = tc.get_fft_peak_ratio(audio, C_SAMPLE_RATE_Hz, freqs)
+    print(f"\n  Expected ratio=2.0; measured={ratio}")
+    assert ratio == pytest.approx(2.0, rel=1e-3)
+
+@pytest.mark.parametrize("freq_a_Hz, freq_b_Hz, n_samples", [
+    (440, 880, 20011),
+    (440, 660, 22051),
+    (1000, 1500, 44101),
+])
+def test_goertzel_ratio(freq_a_Hz:float, freq_b_Hz:float, n_samples:int):
+
+    # Same two-tone cases as the FFT path, which the Goertzel path must agree with
+    freqs = [round(f * n_samples / C_SAMPLE_RATE_Hz) * C_SAMPLE_RATE_Hz / n_samples for f in (freq_a_Hz, freq_b_Hz)]
+    audio = two_tone(n_samples / C_SAMPLE_RATE_Hz, freqs=freqs)
+    _, ratio = tc.get_goertzel_ratio(audio, C_SAMPLE_RATE_Hz, freqs)
+    print(f"\n  Expected ratio=2.0; measured={ratio}")
+    assert ratio == pytest.approx(2.0, rel=1e-3)
+    assert ratio == pytest.approx(tc.get_fft_peak_ratio(audio, C_SAMPLE_RATE_Hz, freqs)[1], rel=1e-3)
+
+def test_time_domain_ratio_gpu(monkeypatch):
+
+    # Stand-in device module backed by NumPy, recording every upload to the device
+    uploaded_n = []
+    def asarray(x, **kwargs):
+        uploaded_n.append(np.size(x))
+        return np.asarray(x, **kwargs)
+    cupy = types.SimpleNamespace(asarray=asarray, sqrt=np.sqrt)
+    cupyx = types.SimpleNamespace(scipy=types.SimpleNamespace(signal=signal))
+    monkeypatch.setattr(tc.ut, 'import_gpu_backend', lambda: (cupy, cupyx))
+    tc._design_bandpass_device.cache_clear()
+
+    try:
+        audio = two_tone(0.25)
+        expected, expected_ratio = tc.get_time_domain_ratio(audio, C_SAMPLE_RATE_Hz, C_FREQS_Hz)
+        values, ratio = tc.get_time_domain_ratio(audio, C_SAMPLE_RATE_Hz, C_FREQS_Hz, use_gpu=True)
+        print(f"\n  Expected values={expected}; measured={values}, uploads={uploaded_n}")
+        assert values == pytest.approx(expected, rel=1e-9)
+        assert ratio == pytest.approx(expected_ratio, rel=1e-9)
+
+        # Filter coefficients are uploaded once, later calls only upload the audio
+        uploaded_n.clear()
+        tc.get_time_domain_ratio(audio, C_SAMPLE_RATE_Hz, C_FREQS_Hz, use_gpu=True)
+        assert uploaded_n == [audio.size]
+    finally:
+        tc._design_bandpass_device.cache_clear()
+
+class FakeInputStream:
+
+    # Stand-in for sd.InputStream that plays int16 frames into the callback from a thread
+    frames = None
+    opened = []
+    status = None
+    stall = False
+
+    def __init__(self, channels, blocksize, callback, finished_callback, **kwargs):
+        self.blocksize = blocksize
+        self.callback = callback
+        self.finished_callback = finished_callback
+        self.closed = False
+        FakeInputStream.opened.append(self)
+
+    def start(self):
+        if not FakeInputStream.stall:
+            threading.Thread(target=self._run).start()
+
+    def _run(self):
+        frames = FakeInputStream.frames
+        try:
+            for start in range(0, len(frames), self.blocksize):
+                status = FakeInputStream.status if FakeInputStream.status is not None else tc.sd.CallbackFlags()
+                block = frames[start:start + self.blocksize]
+                self.callback(block, len(block), None, status)
+        except tc.sd.CallbackStop:
+            pass
+        self.finished_callback()
+
+    def close(self):
+        self.closed = True
+
+@pytest.fixture
+def fake_stream(monkeypatch):
+
+    monkeypatch.setattr(tc.sd, 'InputStream', FakeInputStream)
+    monkeypatch.setattr(tc, 'C_CAPTURE_TIMEOUT_MARGIN_s', 0.5)
+    monkeypatch.setattr(FakeInputStream, 'status', None)
+    monkeypatch.setattr(FakeInputStream, 'stall', False)
+    monkeypatch.setattr(FakeInputStream, 'opened', [])
+    return FakeInputStream
+
+C_DEVICE = {'name': 'fake', 'index': 0, 'hostapi': 0, 'max_input_channels': 2}
+
+def test_sound_device_acquisition(fake_stream):
+
+    # Stereo int16 frames are mixed to mono float32, alternating between two buffers
+    C_DURATION_s = 0.01
+    n_samples = int(C_DURATION_s * C_SAMPLE_RATE_Hz)
+    fake_stream.frames = np.stack([np.arange(2 * n_samples) % 1000, -np.ones(2 * n_samples)], axis=1).astype(np.int16)
+    _, acquire, stop = tc.make_acquisition_handler(C_DEVICE, C_DURATION_s, C_SAMPLE_RATE_Hz)
+
+    first, sr_Hz, warning = acquire()
+    expected = (fake_stream.frames[:n_samples].sum(axis=1) / 2 / 32768).astype(np.float32)
+    assert sr_Hz == C_SAMPLE_RATE_Hz
+    assert warning is None
+    np.testing.assert_allclose(first, expected, rtol=1e-6)
+    second, _, _ = acquire()
+    assert second is not first
+
+    # The next capture was started before acquire() returned, so it completes even if new streams stall
+    fake_stream.stall = True
+    third, _, _ = acquire()
+    assert third is first
+    np.testing.assert_allclose(third, expected, rtol=1e-6)
+
+    # A prefetched capture left unread for longer than a capture is stale and is recorded again
+    time.sleep(3 * C_DURATION_s)
+    with pytest.raises(RuntimeError, match='did not finish'):
+        acquire()
+
+def test_sound_device_acquisition_stop(fake_stream):
+
+    # stop() closes the capture started ahead of the next acquisition, so no stream is left open
+    C_DURATION_s = 0.01
+    fake_stream.frames = np.zeros((int(C_DURATION_s * C_SAMPLE_RATE_Hz), 2), np.int16)
+    _, acquire, stop = tc.make_acquisition_handler(C_DEVICE, C_DURATION_s, C_SAMPLE_RATE_Hz)
+    acquire()
+    assert [stream.closed for stream in fake_stream.opened] == [True, False]
+    stop()
+    assert all(stream.closed for stream in fake_stream.opened)
+
+    # The next acquisition records afresh rather than reusing the dropped prefetch
+    acquire()
+    assert len(fake_stream.opened) == 4
+    stop()
+    stop()
+    assert all(stream.closed for stream in fake_stream.opened)
+
+def test_sound_device_acquisition_errors(fake_stream):
+
+    # A stalled stream or a short capture must raise rather than return the buffer, while dropped
+    # samples are only reported so the monitor keeps running
+    C_DURATION_s = 0.01
+    n_samples = int(C_DURATION_s * C_SAMPLE_RATE_Hz)
+
+    fake_stream.stall = True
+    fake_stream.frames = np.zeros((n_samples, 2), np.int16)
+    with pytest.raises(RuntimeError, match='did not finish'):
+        tc.make_acquisition_handler(C_DEVICE, C_DURATION_s, C_SAMPLE_RATE_Hz)[1]()
+
+    fake_stream.stall = False
+    fake_stream.frames = np.zeros((n_samples // 2, 2), np.int16)
+    with pytest.raises(RuntimeError, match='stopped after'):
+        tc.make_acquisition_handler(C_DEVICE, C_DURATION_s, C_SAMPLE_RATE_Hz)[1]()
+
+    fake_stream.frames = np.zeros((n_samples, 2), np.int16)
+    fake_stream.status = tc.sd.CallbackFlags()
+    fake_stream.status.input_overflow = True
+    wfm, _, warning = tc.make_acquisition_handler(C_DEVICE, C_DURATION_s, C_SAMPLE_RATE_Hz)[1]()
+    assert len(wfm) == n_samples
+    assert 'overflow' in warning
+
+@pytest.mark.parametrize("dev", [
+    ['square', [440, 0.01, 44100, 0]],
+])
+def test_waveform_acquisition(dev:list):
+
+    # Debug waveforms report no warning and have nothing to stop
+    _, acquire, stop = tc.make_acquisition_handler(dev, 0.5, C_SAMPLE_RATE_Hz)
+    wfm, sr_Hz, warning = acquire()
+    assert sr_Hz == 44100 and len(wfm) > 0 and warning is None
+    stop()
+
+def test_keypress_monitor(monkeypatch):
+
+    # One hook handles both directions; auto-repeat while held must not advance twice
+    hooked = []
+    monkeypatch.setattr(tc.keyboard, 'hook_key', lambda key, callback: hooked.append((key, callback)) or callback)
+    advance_event = threading.Event()
+    hook = tc.keypress_monitor(advance_event)
+    assert [key for key, _ in hooked] == ['space']
+    on_space = hooked[0][1]
+    assert hook is on_space
+
+    press, release = types.SimpleNamespace(event_type=tc.keyboard.KEY_DOWN), types.SimpleNamespace(event_type=tc.keyboard.KEY_UP)
+    on_space(press)
+    assert advance_event.is_set()
+    advance_event.clear()
+    on_space(press)
+    assert not advance_event.is_set()
+    on_space(release)
+    on_space(press)
+    assert advance_event.is_set()
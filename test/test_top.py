@@ -1,4 +1,6 @@
-import pytest, os
+import pytest, os, sys, wave, types
+import scipy.fft
+import numpy as np
 import utils.util_funcs as ut
 from utils.wfm import Wfm, WfmSquare, FilterButterworth
 
@@ -40,6 +42,30 @@ def test_create_square_wave_with_guassian(freq_Hz, duration_s, period_std_n):
     print(f"  Expected fft_freq (Hz)={freq_Hz}; measured={freq_fft_Hz}, resolution={1/duration_s}Hz")
     assert freq_fft_Hz == pytest.approx(freq_Hz, abs=0.01*freq_Hz)
     
+@pytest.mark.parametrize("freq_Hz, pad, tolerance_Hz", [
+    (440, False, 0.01),
+    (440, True, 0.3),
+    (440.5, True, 0.3),
+    (441.3, True, 0.3),
+    (1000.7, True, 0.3),
+    (3000.9, True, 0.3),
+])
+def test_fundamental_frequency_interpolation(freq_Hz:float, pad:bool, tolerance_Hz:float):
+    
+    # 0.5s at 44.1kHz gives 2Hz bins.  A tone on a bin must stay on it, one between bins must be
+    # refined to well within a bin.
+    C_SAMPLE_RATE_Hz = 44100
+    C_DURATION_s = 0.5
+    t = np.arange(int(C_SAMPLE_RATE_Hz * C_DURATION_s)) / C_SAMPLE_RATE_Hz
+    wfm = np.sin(2 * np.pi * freq_Hz * t)
+    
+    spectrum = ut.SpectrumCache(wfm, C_SAMPLE_RATE_Hz, pad=pad)
+    bin_Hz = C_SAMPLE_RATE_Hz / spectrum.n_fft
+    nearest_bin_Hz = round(freq_Hz / bin_Hz) * bin_Hz
+    freq_fft_Hz = ut.calculate_fundamental_frequency(wfm, C_SAMPLE_RATE_Hz, spectrum)
+    print(f"\n  Expected freq (Hz)={freq_Hz}; measured={freq_fft_Hz}, nearest bin={nearest_bin_Hz}")
+    assert freq_fft_Hz == pytest.approx(freq_Hz, abs=tolerance_Hz)
+    
 @pytest.mark.parametrize("filepath, freq_Hz, duration_s, sample_rate_Hz", [
     ('test_wav_del_me.wav', 440, 1, 192000),
     ('test_wav_del_me.wav', 440, 1, 44100)
@@ -87,4 +113,100 @@ def test_create_wfm_from_file(freq_Hz:float, duration_s:float):
         
     if os.path.exists(filepath):
         os.remove(filepath)
-    
\ No newline at end of file
+    
+@pytest.mark.parametrize("freq_Hz, amplitude, sample_rate_Hz", [
+    (440, 0.5, 44100),
+    (880.5, 1.0, 192000),
+])
+def test_goertzel_magnitude(freq_Hz:float, amplitude:float, sample_rate_Hz:int):
+    
+    # A sinusoid of amplitude A has a normalized single-sided DFT magnitude of A/2
+    t = np.arange(sample_rate_Hz) / sample_rate_Hz
+    wfm = amplitude * np.sin(2 * np.pi * freq_Hz * t) + 0.1 * np.sin(2 * np.pi * 3 * freq_Hz * t)
+    
+    mag = ut.goertzel_magnitude(wfm, sample_rate_Hz, freq_Hz)
+    print(f"\n  Expected magnitude={amplitude/2}; measured={mag}")
+    assert mag == pytest.approx(amplitude / 2, rel=0.01)
+
+@pytest.mark.parametrize("n_samples", [
+    1,
+    ut.C_GOERTZEL_BLOCK_n,
+    ut.C_GOERTZEL_BLOCK_n + 1,
+    2 * ut.C_GOERTZEL_BLOCK_n + 3,
+])
+def test_goertzel_magnitude_across_blocks(n_samples:int):
+    
+    # Carrying state between blocks must match a direct single-bin DFT for any length
+    C_SAMPLE_RATE_Hz = 44100
+    C_FREQ_Hz = 437.3
+    wfm = np.random.default_rng(0).standard_normal(n_samples).astype(np.float32)
+    
+    expected = abs(np.dot(wfm, np.exp(-2j * np.pi * C_FREQ_Hz * np.arange(n_samples) / C_SAMPLE_RATE_Hz))) / n_samples
+    assert ut.goertzel_magnitude(wfm, C_SAMPLE_RATE_Hz, C_FREQ_Hz) == pytest.approx(expected, rel=1e-9)
+    
+def test_read_stereo_wav_to_mono():
+    
+    C_FILEPATH_TEMP = 'test_wave_stereo_del_me.wav'
+    filepath = C_FILEPATH_TEMP
+    
+    if os.path.exists(filepath):
+        os.remove(filepath)        
+    assert os.path.exists(filepath) == False
+    
+    # Write a stereo file with different content per channel
+    left = np.array([0, 16384, -16384, 32767], dtype=np.int16)
+    right = np.array([0, 0, 16384, 32767], dtype=np.int16)
+    with wave.open(filepath, mode='wb') as wave_write:
+        wave_write.setframerate(44100)
+        wave_write.setnchannels(2)
+        wave_write.setsampwidth(2)
+        wave_write.writeframes(np.column_stack((left, right)).tobytes())
+    
+    wfm = WfmSquare(filepath=filepath)
+    expected = (left.astype(np.float64) + right) / 2 / np.iinfo(np.int16).max
+    assert wfm.sample_rate_Hz == 44100
+    assert wfm.wfm.dtype == np.float32
+    assert wfm.wfm == pytest.approx(expected, abs=1e-6)
+        
+    if os.path.exists(filepath):
+        os.remove(filepath)
+
+@pytest.mark.parametrize("pad, expected_n_fft", [
+    (False, 20011),
+    (True, 20250),
+])
+def test_spectrum_cache_padding(pad:bool, expected_n_fft:int):
+    
+    # Padding is opt-in, the default spectrum keeps tones on their bins
+    spectrum = ut.SpectrumCache(np.zeros(20011, np.float32), 44100, pad=pad)
+    assert spectrum.n_fft == expected_n_fft
+    assert spectrum.fft.size == expected_n_fft // 2 + 1
+
+def test_import_gpu_backend_without_cupy(monkeypatch):
+    
+    # A None entry in sys.modules makes the import fail as if CuPy were not installed
+    monkeypatch.setitem(sys.modules, 'cupy', None)
+    with pytest.raises(ImportError, match='use_gpu requires CuPy'):
+        ut.import_gpu_backend()
+    with pytest.raises(ImportError):
+        ut.SpectrumCache(np.zeros(16, np.float32), 44100, use_gpu=True)
+
+def test_gpu_spectrum_copies_only_peak_bins(monkeypatch):
+    
+    # Stand-in device module backed by NumPy, recording every copy back to the host
+    copied_n = []
+    def asnumpy(x):
+        copied_n.append(np.size(x))
+        return np.asarray(x)
+    cupy = types.SimpleNamespace(asarray=np.asarray, float32=np.float32, multiply=np.multiply, square=np.square,
+                                 argmax=np.argmax, asnumpy=asnumpy)
+    cupyx = types.SimpleNamespace(scipy=types.SimpleNamespace(fft=scipy.fft))
+    monkeypatch.setattr(ut, 'import_gpu_backend', lambda: (cupy, cupyx))
+    
+    C_SAMPLE_RATE_Hz = 44100
+    wfm = np.sin(2 * np.pi * 441.3 * np.arange(C_SAMPLE_RATE_Hz) / C_SAMPLE_RATE_Hz)
+    expected_Hz = ut.calculate_fundamental_frequency(wfm, C_SAMPLE_RATE_Hz, ut.SpectrumCache(wfm, C_SAMPLE_RATE_Hz, pad=True))
+    freq_Hz = ut.calculate_fundamental_frequency(wfm, C_SAMPLE_RATE_Hz, ut.SpectrumCache(wfm, C_SAMPLE_RATE_Hz, pad=True, use_gpu=True))
+    print(f"\n  Expected freq (Hz)={expected_Hz}; measured={freq_Hz}, copied to host={copied_n}")
+    assert freq_Hz == pytest.approx(expected_Hz)
+    assert copied_n == [3]
@@ -1,15 +1,29 @@
-import os, time, yaml, multiprocessing, keyboard
+import os, sys, time, yaml, threading, keyboard
 import sounddevice as sd
-from typing import List, Union, Any
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Union, Callable
 import numpy as np
 import scipy.signal as signal
-from scipy.io.wavfile import write
 import utils.util_funcs as ut
 from utils.wfm import WfmSquare, FilterButterworth
 from rich.live import Live
 from rich.text import Text
 from rich.console import Console
 
+# Prefer the libyaml C loader when PyYAML was built with it
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
+C_INT16_TO_FLOAT = 1.0 / 32768 # Scales int16 samples to [-1, 1)
+C_STREAM_BLOCKSIZE = 2048 # Frames per sound device callback
+C_CAPTURE_TIMEOUT_MARGIN_s = 2.0 # Allowance beyond the capture duration before a stalled stream is an error
+
+# Tones are independent and sosfilt releases the GIL, so they are extracted on worker threads
+_tone_executor = ThreadPoolExecutor(max_workers=os.cpu_count())
+
 def input_devices_as_list() -> list:
     """
     List the available input devices.
@@ -33,17 +47,28 @@ def parse_debug_waveforms(debug_waveforms:dict, ) -> list[str, list]:
         
     return parsed    
         
-def select_devices(devices:List[Union[sd.DeviceList, dict, str]]) -> List[int]:
+def select_devices(devices:List[Union[sd.DeviceList, dict, str]], display_names:List[str], forced_indexes:List[int]=None) -> List[int]:
     """
     Allow user to select multiple device indexes, one per line. Empty input to finish.
     Returns a list of selected indexes.
 
     Args:
         devices (List[Union[sd.DeviceList], dict, str]): Devices (and debug) to choose from.
+        display_names (List[str]): Printable name of each device, same order as devices.
+        forced_indexes (List[int], optional): Indexes to select without prompting, e.g. from the config file.
 
     Returns:
         List[int]: List of selected indexes.
     """    
+    
+    # Non-interactive selection
+    if forced_indexes is not None:
+        selected_indexes = [int(m) for m in forced_indexes]
+        for m in selected_indexes:
+            if not 0 <= m < len(devices):
+                raise ValueError(f'Device index {m} out of range.')
+        return selected_indexes
+    
     selected_indexes = []
     while True:
         user_input = input("\nEnter device index (empty to finish): ").strip()
@@ -53,48 +78,308 @@ def select_devices(devices:List[Union[sd.DeviceList, dict, str]]) -> List[int]:
             m = int(user_input)
             if 0 <= m < len(devices):
                 selected_indexes.append(m)
-                if isinstance(devices[m], dict):
-                    print(f"Selected: {devices[m]['name']}")
-                else:
-                    print(f"Selected: {devices[m][0]} {devices[m][1]}")
+                print(f"Selected: {display_names[m]}")
             else:
                 print("Index out of range.")
         except ValueError:
             print("Invalid input. Please enter a number or empty to finish.")
     return selected_indexes
 
-def get_fft_peak_ratio(audio, sample_rate_Hz, freqs):
-    # FFT
-    fft_data = np.fft.rfft(audio)
-    fft_freqs = np.fft.rfftfreq(len(audio), 1/sample_rate_Hz)
-    magnitudes = np.abs(fft_data)
+@lru_cache(maxsize=16)
+def make_peak_extractor(n_fft:int, sample_rate_Hz:float, freqs:tuple) -> Callable[[np.ndarray], np.ndarray]:
+    """
+    Specialize peak extraction for a fixed FFT length, sample rate and set of target frequencies,
+    which are constant for a whole monitoring session.
+
+    Args:
+        n_fft (int): FFT length.
+        sample_rate_Hz (float): Sample rate.
+        freqs (tuple): Target frequencies in Hz.
+
+    Returns:
+        Callable[[np.ndarray], np.ndarray]: Maps an rfft result to the magnitudes at freqs, on the
+            same device as the rfft result.
+    """
+    
+    # Closest bins, the rfft grid is uniform at k*fs/n_fft so no need to search it
+    bins = np.rint(np.asarray(freqs, dtype=np.float64) * (n_fft / sample_rate_Hz)).astype(np.intp)
+    np.clip(bins, 0, n_fft // 2, out=bins)
+    
+    def extract(fft_data:np.ndarray) -> np.ndarray:
+        return abs(fft_data[bins])
+    
+    return extract
+
+def get_fft_peak_ratio(audio, sample_rate_Hz, freqs, spectrum:ut.SpectrumCache=None):
+    # Bin magnitudes are only comparable on an unpadded FFT; zero-padding moves the tones off-bin and
+    # scallops them by different amounts.  A shared spectrum is reused only if it is unpadded.
+    if spectrum is None or spectrum.n_fft != len(audio):
+        spectrum = ut.SpectrumCache(audio, sample_rate_Hz, n_fft=len(audio))
+
+    values = spectrum.to_host(make_peak_extractor(spectrum.n_fft, sample_rate_Hz, tuple(freqs))(spectrum.fft))
+    ratio = values[0] / values[1] if values[1] != 0 else np.inf
+    return values, ratio
+
+@lru_cache(maxsize=64)
+def _design_bandpass(freq_Hz:float, sample_rate_Hz:float) -> np.ndarray:
+    """
+    Design (once per frequency and sample rate) the +/-10Hz bandpass used for tone extraction.
+
+    Args:
+        freq_Hz (float): Center frequency.
+        sample_rate_Hz (float): Sample rate.
+
+    Returns:
+        np.ndarray: Second-order sections.  Shared between callers, do not modify.
+    """
+    
+    band = [freq_Hz - 10, freq_Hz + 10]
+    return signal.butter(4, band, btype='bandpass', fs=sample_rate_Hz, output='sos')
+
+@lru_cache(maxsize=64)
+def _design_bandpass_device(freq_Hz:float, sample_rate_Hz:float):
+    
+    # The coefficients are fixed for a session, so each bandpass is uploaded to the GPU only once
+    cupy, _ = ut.import_gpu_backend()
+    return cupy.asarray(_design_bandpass(freq_Hz, sample_rate_Hz))
 
-    # Find closest bins
-    bins = [np.argmin(np.abs(fft_freqs - f)) for f in freqs]
-    values = [magnitudes[b] for b in bins]
+def _bandpass_rms(audio, sos, zi=None):
+    
+    if zi is None:
+        filtered, zf = signal.sosfilt(sos, audio), None
+    else:
+        filtered, zf = signal.sosfilt(sos, audio, zi=zi)
+    amplitude = np.sqrt(filtered.dot(filtered) / filtered.size)  # RMS via BLAS dot, no squared temporary
+    return amplitude, zf
+
+def get_time_domain_ratio(audio, sample_rate_Hz, freqs, use_gpu=False):
+    if use_gpu:
+        # Bandpass filters on the GPU, sharing one device copy of the audio between tones
+        cupy, cupyx = ut.import_gpu_backend()
+        audio_d = cupy.asarray(audio)
+        values = []
+        for f in freqs:
+            filtered_d = cupyx.scipy.signal.sosfilt(_design_bandpass_device(f, sample_rate_Hz), audio_d)
+            values.append(float(cupy.sqrt(filtered_d.dot(filtered_d) / filtered_d.size)))
+    else:
+        # Bandpass filters, one tone per worker
+        results = _tone_executor.map(lambda f: _bandpass_rms(audio, _design_bandpass(f, sample_rate_Hz)), freqs)
+        values = [amplitude for amplitude, _ in results]
     ratio = values[0] / values[1] if values[1] != 0 else np.inf
     return values, ratio
 
-def get_time_domain_ratio(audio, sample_rate_Hz, freqs):
-    # Bandpass filters
-    values = []
-    for f in freqs:
-        band = [f - 10, f + 10]
-        sos = signal.butter(4, band, btype='bandpass', fs=sample_rate_Hz, output='sos')
-        filtered = signal.sosfilt(sos, audio)
-        amplitude = np.sqrt(np.mean(filtered**2))  # RMS
-        values.append(amplitude)
+def get_goertzel_ratio(audio, sample_rate_Hz, freqs):
+    # Single-frequency DFTs, no filter design, FFT or filtered copy of the audio
+    values = [ut.goertzel_magnitude(audio, sample_rate_Hz, f) for f in freqs]
     ratio = values[0] / values[1] if values[1] != 0 else np.inf
     return values, ratio
 
-def keypress_monitor(q, ready_event:Any):
-    ready_event.set()
-    while True:
-        if keyboard.is_pressed('space'):
-            q.put('space')
-            while keyboard.is_pressed('space'):
-                time.sleep(0.005)  # Debounce
-        time.sleep(0.01)
+class ToneMonitor:
+    """
+    Bandpass RMS tone ratio that keeps filter state between consecutive buffers, so that a
+    continuous stream is filtered without a start-up transient on every buffer.  Call reset()
+    whenever the audio source changes.
+    """
+    
+    def __init__(self, sample_rate_Hz:float, freqs:List[float]):
+        
+        self.sample_rate_Hz = sample_rate_Hz
+        self.freqs = list(freqs)
+        self.sos_per_freq = [_design_bandpass(f, sample_rate_Hz) for f in self.freqs]
+        self.zi_per_freq = [None] * len(self.freqs)
+        
+    def reset(self):
+        
+        self.zi_per_freq = [None] * len(self.freqs)
+        
+    def get_time_domain_ratio(self, audio:np.ndarray):
+        
+        # Seed the state from the first sample of the stream, then carry it forward
+        for i, sos in enumerate(self.sos_per_freq):
+            if self.zi_per_freq[i] is None:
+                self.zi_per_freq[i] = signal.sosfilt_zi(sos) * audio[0]
+                
+        results = list(_tone_executor.map(lambda sos, zi: _bandpass_rms(audio, sos, zi), self.sos_per_freq, self.zi_per_freq))
+        values = [amplitude for amplitude, _ in results]
+        self.zi_per_freq = [zf for _, zf in results]
+        ratio = values[0] / values[1] if values[1] != 0 else np.inf
+        return values, ratio
+
+def keypress_monitor(advance_event:threading.Event) -> Callable:
+    """
+    Hook the space bar so that each press (not each auto-repeat while held) sets the event.
+
+    Args:
+        advance_event (threading.Event): Event checked and cleared by the main loop.
+
+    Returns:
+        Callable: Keyboard hook, pass it to keyboard.unhook() to stop monitoring.
+    """
+    
+    held = [False]
+    
+    # One hook for both directions: keyboard keeps a single remover per key name, so a second hook on
+    # the same key would make the first unhook remove both and the second fail
+    def on_space(event):
+        if event.event_type == keyboard.KEY_DOWN:
+            if not held[0]:
+                held[0] = True
+                advance_event.set()
+        else:
+            held[0] = False  # Debounce
+    
+    return keyboard.hook_key('space', on_space)
+
+class _StreamCapture:
+    """
+    One sound device capture into a preallocated buffer.  The stream starts on construction and runs
+    without blocking the caller; the samples are mixed to mono float32 block by block in the callback,
+    so no whole-capture multi-channel array is made.
+    """
+    
+    def __init__(self, dev:dict, sample_rate_Hz:float, buffer:np.ndarray):
+        
+        self.dev = dev
+        self.sample_rate_Hz = sample_rate_Hz
+        self.buffer = buffer
+        self.offset = 0
+        self.status = sd.CallbackFlags()
+        self.finished = threading.Event()
+        self.finished_s = None
+        self.n_channels = dev['max_input_channels']
+        self.scale = np.float32(C_INT16_TO_FLOAT / self.n_channels)
+        self.stream = sd.InputStream(device=dev['index'], samplerate=sample_rate_Hz, channels=self.n_channels, dtype='int16',
+                                     blocksize=C_STREAM_BLOCKSIZE, callback=self._callback, finished_callback=self._on_finished)
+        self.stream.start()
+        
+    def _callback(self, indata, frames, time_info, status):
+        
+        self.status |= status
+        n = min(frames, len(self.buffer) - self.offset)
+        block = self.buffer[self.offset:self.offset + n]
+        # Channels are summed straight into float32 (exact for int16 sums) and scaled in place
+        if self.n_channels > 1:
+            np.sum(indata[:n], axis=1, dtype=np.float32, out=block)
+        else:
+            block[:] = indata[:n, 0]
+        block *= self.scale
+        self.offset += n
+        if self.offset >= len(self.buffer):
+            raise sd.CallbackStop
+        
+    def _on_finished(self):
+        
+        self.finished_s = time.monotonic()
+        self.finished.set()
+        
+    def is_stale(self, max_age_s:float) -> bool:
+        
+        return self.finished.is_set() and time.monotonic() - self.finished_s > max_age_s
+    
+    def close(self):
+        
+        self.stream.close()
+    
+    def restart(self) -> '_StreamCapture':
+        
+        self.close()
+        return _StreamCapture(self.dev, self.sample_rate_Hz, self.buffer)
+        
+    def wait(self, timeout_s:float) -> tuple[np.ndarray, Union[str, None]]:
+        """
+        Wait for the capture to fill its buffer and close the stream.
+
+        Args:
+            timeout_s (float): Longest time to wait.
+
+        Raises:
+            RuntimeError: If the stream timed out or stopped before the buffer was full.
+
+        Returns:
+            tuple[np.ndarray, Union[str, None]]: The filled buffer, and a warning if the stream reported a
+                problem such as an input overflow (None otherwise).  The buffer is still complete then,
+                so the caller decides whether to use it.
+        """
+        
+        done = self.finished.wait(timeout_s)
+        self.stream.close()
+        if not done:
+            raise RuntimeError(f'Sound device {self.dev['name']} did not finish capturing within {timeout_s}s')
+        if self.offset < len(self.buffer):
+            raise RuntimeError(f'Sound device {self.dev['name']} stopped after {self.offset} of {len(self.buffer)} samples')
+        warning = f'Sound device {self.dev['name']} reported {self.status} during capture' if self.status else None
+        return self.buffer, warning
+
+def make_acquisition_handler(dev:Union[dict, list], duration_s:float, sample_rate_Hz:float) -> tuple[str, Callable[[], tuple[np.ndarray, float, Union[str, None]]], Callable[[], None]]:
+    """
+    Build the acquisition for a device once, so the monitoring loop doesn't re-dispatch on the device type
+    every iteration.
+
+    Args:
+        dev (Union[dict, list]): Sound device or parsed debug waveform.
+        duration_s (float): Capture duration for sound devices.
+        sample_rate_Hz (float): Capture sample rate for sound devices.
+
+    Raises:
+        ValueError: If the device type is not recognized.
+        RuntimeError: From an acquisition, if a sound device capture stalls or stops early.
+
+    Returns:
+        tuple[str, Callable[[], tuple[np.ndarray, float, Union[str, None]]], Callable[[], None]]: Description
+            of the device, a callable returning (waveform, sample rate, warning or None) for each
+            acquisition, and a callable stopping any capture started ahead of the next acquisition.  Call
+            stop before acquiring from another device, since some host APIs only allow one open device.
+            The waveform is reused between acquisitions and is only valid until the next call; copy it to
+            keep it longer.
+    """
+    
+    # Handle sound device case.  Two buffers are allocated once per device and captured into alternately:
+    # as soon as one is full the next capture starts into the other, so recording overlaps the caller's
+    # processing of the buffer just returned.  stop() drops that prefetch when the caller moves on.
+    if isinstance(dev, dict) and 'hostapi' in dev.keys():
+        n_samples = int(duration_s * sample_rate_Hz)
+        buffers = [np.empty(n_samples, dtype=np.float32) for _ in range(2)]
+        pending = None
+        def acquire():
+            nonlocal pending
+            capture, pending = pending, None
+            if capture is None:
+                capture = _StreamCapture(dev, sample_rate_Hz, buffers[0])
+            # A capture that finished long before this call no longer reflects the input, record afresh
+            elif capture.is_stale(duration_s):
+                capture = capture.restart()
+            buffer, warning = capture.wait(duration_s + C_CAPTURE_TIMEOUT_MARGIN_s)
+            pending = _StreamCapture(dev, sample_rate_Hz, buffers[1] if buffer is buffers[0] else buffers[0])
+            return buffer, sample_rate_Hz, warning
+        def stop():
+            nonlocal pending
+            if pending is not None:
+                pending.close()
+                pending = None
+        return f'Sound device: {dev['name']}. {duration_s}s@{sample_rate_Hz}Hz', acquire, stop
+    
+    # Handle the waveform case, the generator and its filter are set up once and a fresh random
+    # waveform is drawn per acquisition
+    elif isinstance(dev, list) and dev[0] == 'square':
+        wfm = WfmSquare(dev[1][0], dev[1][1], dev[1][3], sample_rate_Hz=dev[1][2])
+        wfm.add_filter_to_list(FilterButterworth(wfm.sample_rate_Hz, 10000, 10, "low"))
+        def acquire():
+            wfm.create_wfm()
+            time.sleep(len(wfm.wfm)/wfm.sample_rate_Hz)
+            return wfm.wfm, wfm.sample_rate_Hz, None
+        return f'Generating waveform: {dev}', acquire, lambda: None
+    
+    # Handle the filename case, the file is only read once
+    elif isinstance(dev, list) and dev[0] == 'file':
+        wfm = WfmSquare(filepath=dev[1])
+        def acquire():
+            time.sleep(len(wfm.wfm)/wfm.sample_rate_Hz)
+            return wfm.wfm, wfm.sample_rate_Hz, None
+        return f'File: {dev}', acquire, lambda: None
+    
+    # Otherwise
+    else:
+        raise ValueError(f'Unexpected device: {dev}')
 
 def main():
 
@@ -104,10 +389,11 @@ def main():
 
     # Parse config file and load values
     with open(filename_cfg, 'r') as f:
-        cfg = yaml.safe_load(f)
+        cfg = yaml.load(f, Loader=SafeLoader)
         
     duration_s = cfg['duration_s']
     sample_rate_Hz = cfg['sample_rate_Hz']
+    use_gpu = cfg.get('use_gpu', False)
     
     print(f'\nDuration is set to {duration_s}s.  \nFrequency resolution limited to {1/duration_s:.3f}Hz\n')
 
@@ -115,24 +401,19 @@ def main():
     devices = input_devices_as_list()
     devices.extend(parse_debug_waveforms(cfg['debug']['waveforms']))
     
-    # List all the things...
-    print("Available input devices:")
-    for i, dev in enumerate(devices):
-        if isinstance(dev, dict):
-            name = f'{dev['name']}'
-        else:
-            name = f'{dev[0]} {dev[1]}'
-        print(f"{i}: {name}")
+    # List all the things...  Names are formatted once and reused for selection.
+    display_names = [dev['name'] if isinstance(dev, dict) else f'{dev[0]} {dev[1]}' for dev in devices]
+    sys.stdout.write("Available input devices:\n" + "\n".join(f"{i}: {name}" for i, name in enumerate(display_names)) + "\n")
+    
+    # Allow user selection, unless the config file already picks the devices
+    selected_indexes = select_devices(devices, display_names, cfg.get('input_devices') or None)
     
-    # Allow user selection
-    selected_indexes = select_devices(devices)
+    # Build the acquisition for each selected device once, up front
+    handlers = [make_acquisition_handler(devices[i], duration_s, sample_rate_Hz) for i in selected_indexes]
     
-    # Spawn background process to watch for keypresses
-    keypress_queue = multiprocessing.Queue()
-    ready_event = multiprocessing.Event()
-    keypress_proc = multiprocessing.Process(target=keypress_monitor, args=(keypress_queue, ready_event), daemon=True)
-    keypress_proc.start()
-    ready_event.wait()
+    # Hook keypresses, the keyboard listener thread sets the event
+    advance_event = threading.Event()
+    keypress_hook = keypress_monitor(advance_event)
     
     print("\nPress Ctrl+C to stop.\n")
     try:
@@ -144,49 +425,20 @@ def main():
         with Live(f'Starting', refresh_per_second=4) as live:
             while True:
                 
-                this_dev = devices[selected_indexes[m]]
-                
                 # Screen contents
                 idx_animate += 1
                 lines = [Text(str_animate[idx_animate % len(str_animate)], style='purple')]
                 lines.append(Text(f'Press space to capture and advance to next interface.  Ctr+C to quit.', style=None))
-                                
-                # Handle sound device case
-                if isinstance(this_dev, dict) and 'hostapi' in this_dev.keys():
-                    lines.append(f'Sound device: {this_dev['name']}. {duration_s}s@{sample_rate_Hz}Hz')
-                    sd.default.device = (this_dev['index'], None)
-                    audio = sd.rec(int(duration_s * sample_rate_Hz), samplerate=sample_rate_Hz, channels=this_dev['max_input_channels'], dtype='float32')
-                    sd.wait()
-                    # Convert to mono if needed
-                    if audio.ndim > 1 and audio.shape[1] > 1:
-                        wfm_data = np.mean(audio, axis=1)
-                    else:
-                        wfm_data = audio.flatten()
-                    sr_Hz = sample_rate_Hz
                 
-                # Handle the waveform case
-                elif isinstance(this_dev, list) and this_dev[0] == 'square':
-                    lines.append(f'Generating waveform: {this_dev}')
-                    wfm = WfmSquare(this_dev[1][0], this_dev[1][1], this_dev[1][3], sample_rate_Hz=this_dev[1][2])
-                    wfm.add_filter_to_list(FilterButterworth(wfm.sample_rate_Hz, 10000, 10, "low"))
-                    wfm.create_wfm()
-                    wfm_data = wfm.wfm
-                    sr_Hz = wfm.sample_rate_Hz
-                    time.sleep(len(wfm_data)/sr_Hz)
-                                    
-                # Handle the filename case
-                elif isinstance(this_dev, list) and this_dev[0] == 'file':
-                    lines.append(f'File: {this_dev}')
-                    wfm = WfmSquare(filepath=this_dev[1])
-                    wfm_data = wfm.wfm
-                    sr_Hz = wfm.sample_rate_Hz
-                    time.sleep(len(wfm_data)/sr_Hz)
-                    
-                # Otherwise
-                else:
-                    raise ValueError(f'Unexpected device: {this_dev}')
-
-                freq_Hz = ut.calculate_fundamental_frequency(wfm_data, sr_Hz)
+                # Acquire from the current device
+                description, acquire, _ = handlers[m]
+                lines.append(description)
+                wfm_data, sr_Hz, warning = acquire()
+                if warning is not None:
+                    lines.append(Text(warning, style='red'))
+
+                spectrum = ut.SpectrumCache(wfm_data, sr_Hz, pad=True, use_gpu=use_gpu)  # Frequency only, padding is safe
+                freq_Hz = ut.calculate_fundamental_frequency(wfm_data, sr_Hz, spectrum)
                 
                 # Calculate ratio if there is a previous result then print result
                 freq_text = Text('Freq=', style=None)
@@ -205,20 +457,20 @@ def main():
                 live.update(output)
                 
                 # Look for space to advance
-                while not keypress_queue.empty():
-                    msg = keypress_queue.get()
-                    if msg == 'space':
-                        m = (m + 1) % len(selected_indexes)
-                        last_dev_freq_Hz = freq_Hz
+                if advance_event.is_set():
+                    advance_event.clear()
+                    handlers[m][2]()  # Only the current device may be capturing
+                    m = (m + 1) % len(selected_indexes)
+                    last_dev_freq_Hz = freq_Hz
             
     except KeyboardInterrupt:
         print("\nStopped.")
     
-    # Terminate background process
+    # Remove keyboard hook and close any capture still running
     finally:
-        if 'keypress_proc' in locals() and keypress_proc.is_alive():
-            keypress_proc.terminate()
-            keypress_proc.join()
+        keyboard.unhook(keypress_hook)
+        for _, _, stop in handlers:
+            stop()
         
 if __name__ == "__main__":
     main()
\ No newline at end of file
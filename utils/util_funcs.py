@@ -1,9 +1,9 @@
 import sys, math
 import numpy as np
-from scipy.signal import butter, filtfilt
-from scipy.io import wavfile
+import scipy.fft as sfft
+from scipy.signal import butter, filtfilt, lfilter
+from functools import cached_property, lru_cache
 from typing import Tuple
-import matplotlib.pyplot as plt
 
 # def analyze_transitions(wfm: np.ndarray, threshold: float, pos_edge: bool) -> tuple[float, float, int]:
 def analyze_transitions(wfm: np.ndarray, threshold: float, pos_edge: bool) -> tuple[float, float, int]:
@@ -22,54 +22,182 @@ def analyze_transitions(wfm: np.ndarray, threshold: float, pos_edge: bool) -> tu
             3) count: Number of transitions.
     """    
     
-    # Create a boolean mask for threshold crossing
+    # Compare against the threshold once, then find crossings from neighbouring mask entries.  On
+    # booleans a > b is a & ~b, so each edge polarity is a single ufunc with no inverted temporary.
     if pos_edge:
-        crossings = (wfm[:-1] < threshold) & (wfm[1:] >= threshold)
+        above = wfm >= threshold
+        crossings = above[1:] > above[:-1]
     else:
-        crossings = (wfm[:-1] > threshold) & (wfm[1:] <= threshold)
-
-    # Get indices where transitions occur
-    transition_indices = np.where(crossings)[0] + 1  # +1 to get the index of the crossing point
-
-    # Calculate durations between transitions
-    if len(transition_indices) >= 2:
-        durations = np.diff(transition_indices)
-        mean = float(np.mean(durations))
-        std = float(np.std(durations))
+        above = wfm > threshold
+        crossings = above[:-1] > above[1:]
+
+    # Get indices where transitions occur.  The +1 offset to the crossing point cancels out of
+    # the durations so it is not applied.
+    transition_indices = np.flatnonzero(crossings)
+
+    # Calculate durations between transitions.  The durations telescope, so the mean only needs
+    # the first and last transition.
+    count = max(len(transition_indices) - 1, 0)
+    if count > 0:
+        mean = float(transition_indices[-1] - transition_indices[0]) / count
+        std = float(np.std(np.diff(transition_indices)))
     else:
-        durations = np.array([])
         mean = 0.0
         std = 0.0
 
-    count = len(durations)
-
     return mean, std, count
 
-def calculate_fundamental_frequency(wfm: np.ndarray, sample_rate_Hz: float) -> float:
+def import_gpu_backend():
+    """
+    Import the optional CuPy GPU backend.
+
+    Raises:
+        ImportError: If CuPy is not installed.
+
+    Returns:
+        tuple: The cupy and cupyx modules, with cupyx.scipy.fft and cupyx.scipy.signal loaded.
+    """
+    
+    try:
+        import cupy, cupyx.scipy.fft, cupyx.scipy.signal
+    except ImportError as e:
+        raise ImportError(f'use_gpu requires CuPy, e.g. pip install cupy-cuda12x') from e
+    
+    return cupy, cupyx
+
+@lru_cache(maxsize=32)
+def _fast_len(n: int) -> int:
+    
+    # Capture lengths are fixed for a session, so the FFT length is only worked out once per length
+    return sfft.next_fast_len(n, real=True)
+
+class SpectrumCache:
+    """
+    Real FFT of a waveform, computed on first use and then shared by every analysis of the same buffer.
+    The transform runs in single precision, which is ample for peak finding and halves memory traffic.
+
+    Args:
+        wfm (np.ndarray): Input waveform.
+        sample_rate_Hz (float): Sample rate.
+        n_fft (int, optional): FFT length, the waveform is zero-padded up to it.  Defaults to len(wfm),
+            or to the next fast length (scipy.fft.next_fast_len) when pad is set.
+        pad (bool, optional): Zero-pad to a fast FFT length.  A padded spectrum is only valid for locating
+            peaks: tones no longer sit on bins, so bin magnitudes are scalloped by differing amounts and
+            must not be compared.
+        use_gpu (bool, optional): Compute the FFT with cuFFT via CuPy.  Only pays off for captures of
+            roughly a million samples or more.  The spectrum then stays on the device as a CuPy array;
+            work on it with xp and copy back only the few values needed with to_host().
+
+    Raises:
+        ImportError: If use_gpu is set and CuPy is not installed.
+    """
+    
+    def __init__(self, wfm: np.ndarray, sample_rate_Hz: float, n_fft: int = None, pad: bool = False, use_gpu: bool = False):
+        
+        self.wfm = wfm
+        self.sample_rate_Hz = sample_rate_Hz
+        self.n_fft = n_fft or (_fast_len(len(wfm)) if pad else len(wfm))
+        self.use_gpu = use_gpu
+        self.xp = import_gpu_backend()[0] if use_gpu else np  # Array module the spectrum lives in
+        
+    def to_host(self, x) -> np.ndarray:
+        
+        return self.xp.asnumpy(x) if self.use_gpu else x
+        
+    @cached_property
+    def fft(self) -> np.ndarray:
+        
+        if self.use_gpu:
+            cupy, cupyx = import_gpu_backend()
+            wfm_d = cupy.asarray(self.wfm, dtype=cupy.float32)
+            return cupyx.scipy.fft.rfft(wfm_d, n=self.n_fft)
+        
+        # The transform may scratch its input only when that is our own float32 copy, never the caller's array
+        wfm = np.asarray(self.wfm, dtype=np.float32)
+        return sfft.rfft(wfm, n=self.n_fft, workers=-1, overwrite_x=wfm is not self.wfm)
+
+C_PEAK_NOISE_FLOOR = 1e-12 # Neighbour/peak power below which a peak is taken to be exactly on its bin
+
+def calculate_fundamental_frequency(wfm: np.ndarray, sample_rate_Hz: float, spectrum: SpectrumCache = None) -> float:
     """
     Estimate the fundamental frequency of a waveform using FFT.
 
     Args:
         wfm (np.ndarray): Input waveform.
         sample_rate_Hz (float): Sample rate.
+        spectrum (SpectrumCache, optional): Spectrum of wfm to reuse rather than computing a new FFT.
+            Defaults to one zero-padded to a fast length, which is fine for locating the peak.
 
     Returns:
         float: Fundamental frequency in Hz
     """    
     
-    # Compute FFT and frequency bins
-    fft = np.fft.rfft(wfm)
-    freqs = np.fft.rfftfreq(len(wfm), d=1/sample_rate_Hz)
-    magnitude = np.abs(fft)
+    # Compute FFT.  Squared magnitude has the same peak as magnitude and needs no sqrt.
+    if spectrum is None:
+        spectrum = SpectrumCache(wfm, sample_rate_Hz, pad=True)
+    xp, fft = spectrum.xp, spectrum.fft
+    power = xp.multiply(fft.real, fft.real)
+    power += xp.square(fft.imag)
+    if len(power) < 2:
+        return 0.0
+
+    # Find index of peak power, ignoring DC component.  Only the peak and its neighbours leave the device.
+    peak_index = 1 + int(xp.argmax(power[1:]))
+
+    # Refine the peak between bins with a parabola through the log power of it and its neighbours.  The
+    # main lobe is close to Gaussian in log power, a parabola on linear power biases towards the bin.
+    # Neighbours at the rounding noise floor mean the tone is on the bin, and their log is just noise.
+    offset = 0.0
+    if peak_index < len(power) - 1:
+        neighbours = spectrum.to_host(power[peak_index - 1:peak_index + 2])
+        if neighbours.min() > C_PEAK_NOISE_FLOOR * neighbours[1]:
+            a, b, c = np.log(neighbours.astype(np.float64))
+            denom = a - 2 * b + c
+            if denom != 0:
+                offset = 0.5 * (a - c) / denom
+
+    # Bins are spaced sample_rate_Hz/n_fft apart
+    freq_Hz = (peak_index + offset) * sample_rate_Hz / spectrum.n_fft
 
-    # Ignore DC component
-    magnitude[0] = 0
+    return float(freq_Hz)
 
-    # Find index of peak magnitude
-    peak_index = np.argmax(magnitude)
-    freq_Hz = freqs[peak_index]
+C_GOERTZEL_BLOCK_n = 8192 # Samples per lfilter call, bounds the scratch memory of goertzel_magnitude
 
-    return float(freq_Hz)
+def goertzel_magnitude(wfm: np.ndarray, sample_rate_Hz: float, freq_Hz: float) -> float:
+    """
+    Estimate the amplitude of a single frequency component of a waveform using the Goertzel algorithm.
+
+    The recurrence s[n] = x[n] + coeff*s[n-1] - s[n-2] is evaluated as an IIR filter in compiled code
+    rather than a Python loop.  Only the final two states are needed, so the waveform is fed through in
+    fixed-size blocks with the filter state carried between them; no waveform-length copy or output
+    array is made.
+
+    Args:
+        wfm (np.ndarray): Input waveform.
+        sample_rate_Hz (float): Sample rate.
+        freq_Hz (float): Frequency of interest, need not fall on an FFT bin.
+
+    Returns:
+        float: Magnitude of the frequency component, normalized by the number of samples.
+    """
+
+    n = len(wfm)
+    if n == 0:
+        return 0.0
+
+    coeff = 2 * math.cos(2 * math.pi * freq_Hz / sample_rate_Hz)
+    b, a = [1.0], [1.0, -coeff, 1.0]
+    zi = np.zeros(2)
+    s1 = s2 = 0.0
+    for start in range(0, n, C_GOERTZEL_BLOCK_n):
+        states, zi = lfilter(b, a, wfm[start:start + C_GOERTZEL_BLOCK_n], zi=zi)
+        if len(states) >= 2:
+            s1, s2 = states[-1], states[-2]
+        else:
+            s1, s2 = states[-1], s1
+    power = s1 * s1 + s2 * s2 - coeff * s1 * s2
+
+    return float(math.sqrt(max(power, 0.0)) / n)
 
 def parse_named_args() -> dict:
     """
@@ -87,20 +215,23 @@ def parse_named_args() -> dict:
     args_parsed = {}
     i = 0
 
-    while i < len(args):
+    n_args = len(args)
+
+    while i < n_args:
         arg = args[i]
+        prefix = arg[:2]
 
-        if arg.startswith('--'):
+        if prefix == '--':
             key = arg[2:]
             # Check if next item exists and isn't another flag
-            if i + 1 < len(args) and not args[i + 1].startswith('-'):
+            if i + 1 < n_args and args[i + 1][:1] != '-':
                 args_parsed[key] = args[i + 1]
                 i += 2
             else:
                 args_parsed[key] = None
                 i += 1
 
-        elif arg.startswith('-'):
+        elif prefix[:1] == '-':
             key = arg[1:]
             args_parsed[key] = True
             i += 1
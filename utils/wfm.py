@@ -1,19 +1,26 @@
 import math, os
 import numpy as np
-import matplotlib.pyplot as plt
 from abc import ABC, abstractmethod
 from enum import Enum
 from dataclasses import dataclass
-from scipy.signal import butter, filtfilt
-from scipy.io.wavfile import write
+from functools import lru_cache
+from scipy.signal import butter, sosfiltfilt
 import wave
 
-@dataclass
+@dataclass(frozen=True)
 class FilterButterworth:
     sample_rate_Hz: int
     cutoff_Hz:      float
     order:          int
     type:           str
+
+@lru_cache(maxsize=32)
+def _design_butterworth(filter_settings:FilterButterworth) -> np.ndarray:
+    
+    # Settings are frozen so identical filters (e.g. one per generated waveform) share one design
+    f_nyquist_Hz = filter_settings.sample_rate_Hz / 2
+    normalized_cutoff_Hz = filter_settings.cutoff_Hz / f_nyquist_Hz
+    return butter(filter_settings.order, normalized_cutoff_Hz, btype=filter_settings.type, output='sos')
     
 class Wfm(ABC):
     
@@ -25,7 +32,7 @@ class Wfm(ABC):
             raise ValueError(f'You must specify at least one of (filepath) or (freq_Hz and duration_s)')
         
         self._filter_list = []
-        self.wfm = []
+        self.wfm = np.empty(0, dtype=np.float32)
         
         if filepath:
             self._read_wave(filepath)
@@ -38,10 +45,7 @@ class Wfm(ABC):
     def add_filter_to_list(self, filter_settings:FilterButterworth):
         
         if isinstance(filter_settings, FilterButterworth):
-            f_nyquist_Hz = filter_settings.sample_rate_Hz / 2
-            normalized_cutoff_Hz = filter_settings.cutoff_Hz / f_nyquist_Hz
-            b,a = butter(filter_settings.order, normalized_cutoff_Hz, btype=filter_settings.type)
-            self._filter_list.append([filter_settings, [b,a]])
+            self._filter_list.append([filter_settings, _design_butterworth(filter_settings)])
         else:
             raise ValueError(f'Invalid filter settings for filter_type')
     
@@ -54,8 +58,9 @@ class Wfm(ABC):
         
         # TODO, Make this a little more dynamic...
         bits_n = 16
-        scale = 0.8 * (((2**bits_n)/2)-1) / max(self.wfm) # 80% of full-scale
-        wfm_scaled = (self.wfm * scale).astype(np.int16)
+        scale = 0.8 * np.iinfo(np.int16).max / float(np.abs(self.wfm).max()) # 80% of full-scale
+        wfm_scaled = np.empty(len(self.wfm), dtype=np.int16)
+        np.multiply(self.wfm, scale, out=wfm_scaled, casting='unsafe') # Scale and truncate in one pass
         with wave.open(filepath, mode='wb') as wave_write:
             wave_write.setframerate(self.sample_rate_Hz)
             wave_write.setnchannels(1)
@@ -67,7 +72,7 @@ class Wfm(ABC):
         for filter_list_item in self._filter_list:
             orig_filter_settings = filter_list_item[0]
             if isinstance(orig_filter_settings, FilterButterworth):
-                self.wfm = filtfilt(filter_list_item[1][0], filter_list_item[1][1], self.wfm)        
+                self.wfm = sosfiltfilt(filter_list_item[1], self.wfm).astype(np.float32)
 
     def _read_wave(self, filepath: str):
         
@@ -86,15 +91,15 @@ class Wfm(ABC):
         else:
             raise ValueError(f"Unsupported sample width: {sampwidth}")
 
-        # Convert bytes to numpy array
-        audio = np.frombuffer(audio_bytes, dtype=dtype)
+        # Convert bytes to numpy array, normalized to [-1, 1] float32 in a single cast and in-place scale
+        audio = np.frombuffer(audio_bytes, dtype=dtype).astype(np.float32)
+        audio *= np.float32(1.0 / np.iinfo(dtype).max)
 
         # If multi-channel, reshape and average to mono
         if n_channels > 1:
-            audio = audio.reshape(-1, n_channels)
-            audio = audio.mean(axis=1).astype(dtype)
+            audio = audio.reshape(-1, n_channels).mean(axis=1)
 
-        self.wfm = audio.astype(np.float32) / np.iinfo(dtype).max  # Normalize to [-1, 1] float
+        self.wfm = audio
             
     @abstractmethod
     def _create_wfm(self):
@@ -105,7 +110,7 @@ class WfmSquare(Wfm):
     def __init__(self, freq_Hz:float=None, duration_s:float=None, period_std_s:float=None, sample_rate_Hz:int=None, filepath:str=None):
         
         # Sanitize arguments
-        if filepath is not None and (period_std_s and freq_Hz) and period_std_s > 0.25 * 1 / freq_Hz:
+        if filepath is None and (period_std_s and freq_Hz) and period_std_s > 0.25 * 1 / freq_Hz:
             raise ValueError(f'Period standard deviation exceeds 25% of full period.')
         
         super().__init__(freq_Hz, duration_s, sample_rate_Hz, filepath)
@@ -120,21 +125,21 @@ class WfmSquare(Wfm):
         period_std_n = self.period_std_s * self.sample_rate_Hz
         period_n = self.sample_rate_Hz / self.freq_Hz # Keep these fractional, as part of normal dist to round.
         periods_n = rand_gen.normal(period_n, period_std_n, math.ceil(duration_n / period_n)).round().astype(int)
+        np.maximum(periods_n, 1, out=periods_n) # Tail draws can't yield empty or negative periods
 
-        # Create waveform array
+        # Make the waveform by concatenating the randomly distributed periods.  Always start off (0)
+        # and remain off for 50% of mean period time, take up rest of period on (1.0).  Rather than
+        # slicing period by period, mark +1 where each on-interval starts and -1 where it ends, then
+        # integrate the edges into the waveform in one pass.
         n_samples_half_mean_period = math.floor(period_n / 2)
-        wfm = np.zeros(duration_n)
-
-        # Iterate over all the randomly distributed period lengths and make the waveform by
-        # concatenating the periods.  Always start off (0) and remain off for 50% of mean 
-        # period time, take up rest of period on (1.0).  Initialized array is already at 0
-        # so just need to set ones.
-        idx = 0
-        for this_period_n in periods_n:
-            if (slice_end := idx + this_period_n) > len(wfm):
-                slice_end = len(wfm)
-            wfm[idx + n_samples_half_mean_period:slice_end] = 1.0
-            idx = idx + this_period_n
+        ends = np.cumsum(periods_n)
+        starts = ends - periods_n + n_samples_half_mean_period
+        ends = np.minimum(ends, duration_n)
+        on = starts < ends  # Drops periods shorter than the off time and any past the end
+        edges = np.zeros(duration_n, dtype=np.float32) # Running sum stays 0/1, so float32 is exact
+        np.add.at(edges, starts[on], 1.0)
+        np.add.at(edges, ends[on & (ends < duration_n)], -1.0) # An interval cut off at the end never turns off
+        np.cumsum(edges, out=edges)
 
-        self.wfm = wfm
+        self.wfm = edges
 